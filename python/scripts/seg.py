@@ -1,79 +1,98 @@
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import random
 import json
 import argparse
-from PIL import Image
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
-import matplotlib.pyplot as plt
+import os
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.modeling import image_encoder as sam_image_encoder
+from pycocotools import mask as mask_utils
 
 # Style library will be loaded from command line argument
 STYLE_LIBRARY = {}
 
+# Region types produced by the classifier
+REGION_TYPES = ("main_walls", "side_walls", "upper_lower_walls", "pillars", "balcony", "roof", "doors", "windows")
+
+CPU_POINTS_PER_BATCH = 64
+SERVE_REQUEST_KEYS = frozenset(("input", "output_styled", "output_blended", "style", "blend_alpha", "min_mask_area", "mask_nms_iou"))
+
 def hex_to_bgr(hex_color):
-    hex_color = hex_color.lstrip('#')
-    r = int(hex_color[0:2], 16)
-    g = int(hex_color[2:4], 16)
-    b = int(hex_color[4:6], 16)
+    r, g, b = bytes.fromhex(hex_color.lstrip('#'))
     return (b, g, r)
 
 def classify_region(mask, image=None):
     """
-    Enhanced region classifier for architectural elements.
+    Enhanced region classifier for architectural elements; classify_region_stats for a single mask.
     Returns: one of 'main_walls', 'side_walls', 'upper_lower_walls', 'pillars', 'balcony', 'roof', 'doors', 'windows'
     """
-    ys, xs = np.where(mask)
-    if len(ys) == 0 or len(xs) == 0:
-        return "main_walls"  # fallback
+    return classify_region_stats(mask.shape, *region_stats_batch(mask[None], image))[0]
+
+def region_stats_batch(stack, image=None):
+    """
+    Per-mask (min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r) arrays for an (N, H, W) uint8 stack.
+    """
+    n, h, w = stack.shape
+    rows = stack.any(axis=2)
+    cols = stack.any(axis=1)
+    min_y = rows.argmax(axis=1)
+    max_y = h - 1 - rows[:, ::-1].argmax(axis=1)
+    min_x = cols.argmax(axis=1)
+    max_x = w - 1 - cols[:, ::-1].argmax(axis=1)
+    mask_area = stack.reshape(n, -1).sum(axis=1, dtype=np.int64)
+
+    # Average colors (if image is provided)
+    avg_b = avg_g = avg_r = np.zeros(n)
+    if image is not None:
+        color_sums = np.einsum("nhw,hwc->nc", stack, image, dtype=np.float64)
+        avg_b, avg_g, avg_r = (color_sums / np.maximum(mask_area, 1)[:, None]).T
+    return min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r
 
-    h, w = mask.shape
-    min_y, max_y = ys.min(), ys.max()
-    min_x, max_x = xs.min(), xs.max()
+def classify_region_stats(shape, min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r):
+    """
+    Region classification heuristics (the single rule table) evaluated element-wise over per-mask statistics.
+    """
+    h, w = shape
     box_height = max_y - min_y + 1
     box_width = max_x - min_x + 1
     box_area = box_height * box_width
-    mask_area = np.sum(mask)
     area_ratio = mask_area / (h * w)
     aspect = box_width / (box_height + 1e-5)
     center_y = (min_y + max_y) / 2 / h
     center_x = (min_x + max_x) / 2 / w
 
-    # Average color (if image is provided)
-    avg_b, avg_g, avg_r = 0, 0, 0
-    if image is not None:
-        region_pixels = image[mask == 1]
-        if len(region_pixels) > 0:
-            avg_b, avg_g, avg_r = np.mean(region_pixels, axis=0)
-
-    # --- Heuristics ---
-    if center_y < 0.2 and aspect > 2.5 and box_height < 0.15 * h:
-        return "roof"
-    if 0.2 < center_y < 0.5 and aspect > 2.0 and 0.08 < box_height/h < 0.25:
-        return "balcony"
-    if aspect < 0.25 and box_height > 0.4 * h and (center_x < 0.2 or center_x > 0.8):
-        return "pillars"
-    if area_ratio > 0.15 and (center_x < 0.3 or center_x > 0.7):
-        return "side_walls"
-    if area_ratio > 0.15 and center_y < 0.5:
-        return "upper_lower_walls"
-    if area_ratio > 0.15 and center_y >= 0.5:
-        return "main_walls"
-    if center_y > 0.7 and aspect > 0.6 and box_area > 0.01 * h * w:
-        if avg_r < 120 and avg_g < 120 and avg_b < 120:
-            return "doors"
-    if (aspect < 0.5 and box_height > 0.1 * h) or (center_y < 0.6 and box_area < 0.15 * h * w):
-        if avg_b > avg_r and avg_b > avg_g and avg_b > 130:
-            return "windows"
-        else:
-            return "windows"
-    if area_ratio > 0.10:
-        return "main_walls"
-    return "main_walls"
-
-def recommend_style_for_region(region_type, style, style_library):
-    """
-    Picks a random color/texture/material/finish for the region type from the selected style.
+    # --- Heuristics: empty, roof, balcony, pillars, side/upper/main walls, doors, windows; first match wins ---
+    conditions = [
+        mask_area == 0,
+        (center_y < 0.2) & (aspect > 2.5) & (box_height < 0.15 * h),
+        (0.2 < center_y) & (center_y < 0.5) & (aspect > 2.0) & (0.08 < box_height / h) & (box_height / h < 0.25),
+        (aspect < 0.25) & (box_height > 0.4 * h) & ((center_x < 0.2) | (center_x > 0.8)),
+        (area_ratio > 0.15) & ((center_x < 0.3) | (center_x > 0.7)),
+        (area_ratio > 0.15) & (center_y < 0.5),
+        (area_ratio > 0.15) & (center_y >= 0.5),
+        (center_y > 0.7) & (aspect > 0.6) & (box_area > 0.01 * h * w)
+            & (avg_r < 120) & (avg_g < 120) & (avg_b < 120),
+        ((aspect < 0.5) & (box_height > 0.1 * h)) | ((center_y < 0.6) & (box_area < 0.15 * h * w)),
+    ]
+    choices = ["main_walls", "roof", "balcony", "pillars", "side_walls", "upper_lower_walls", "main_walls", "doors", "windows"]
+    return np.select(conditions, choices, default="main_walls").tolist()
+
+def classify_regions_batch(masks, image=None):
+    """
+    Vectorized classify_region over all masks at once. Returns one region type per mask.
+    """
+    if not masks:
+        return []
+    stack = np.stack([mask_dict["segmentation"] for mask_dict in masks]).view(np.uint8)
+    return classify_region_stats(stack.shape[1:], *region_stats_batch(stack, image))
+
+def style_options_for_region(region_type, style, style_library):
+    """
+    Style recommendations available for the region type in the selected style.
     """
     region_styles = style_library.get(region_type, {})
     style_list = region_styles.get(style, [])
@@ -86,35 +105,219 @@ def recommend_style_for_region(region_type, style, style_library):
             if style_library[region].get(style):
                 style_list = style_library[region][style]
                 break
-    rec = random.choice(style_list)
-    return rec["color"], rec["texture"], rec["material"], rec["finish"], rec["rating"], rec["keywords"]
-
-def apply_style_recommendations(original_img, masks, style, style_library):
-    output_img = original_img.copy()
-    for idx, mask_dict in enumerate(masks):
-        mask = mask_dict["segmentation"]
-        region_type = classify_region(mask, original_img)
-        color_hex, texture, material, finish, rating, keywords = recommend_style_for_region(region_type, style, style_library)
-        print(f"[Region {idx}] {region_type.upper()} | Color: {color_hex} | Texture: {texture} | Material: {material} | Finish: {finish} | Rating: {rating} | Keywords: {keywords}")
-        color_bgr = hex_to_bgr(color_hex)
-        output_img[mask == 1] = color_bgr
-    return output_img
+    return style_list
 
-def main():
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='AI House Exterior Design')
-    parser.add_argument('--input', required=True, help='Path to input image')
-    parser.add_argument('--output_styled', required=True, help='Path to save styled output image')
-    parser.add_argument('--output_blended', required=True, help='Path to save blended output image')
-    parser.add_argument('--style', required=True, help='Design style to apply')
-    parser.add_argument('--model', required=True, help='Path to SAM model checkpoint')
-    parser.add_argument('--style_library', required=True, help='Path to style library JSON')
-    parser.add_argument('--blend_alpha', type=float, default=0.5, help='Blending factor (0.0-1.0)')
-    
-    args = parser.parse_args()
-    
+def build_style_cache(style, style_library):
+    """
+    Region type -> list of (recommendation, bgr_color), resolved once per run.
+    """
+    return {
+        region_type: [
+            (rec, hex_to_bgr(rec["color"])) for rec in style_options_for_region(region_type, style, style_library)
+        ]
+        for region_type in REGION_TYPES
+    }
+
+def build_label_map(masks):
+    """
+    Collapses the masks into one (H, W) label image: i means mask i-1 (last one wins), 0 means background.
+    """
+    seg = np.stack([mask_dict["segmentation"] for mask_dict in masks]).view(np.uint8)
+    labels = len(masks) - seg[::-1].argmax(axis=0)
+    labels[seg.max(axis=0) == 0] = 0
+    return labels.astype(np.min_scalar_type(len(masks)))
+
+def is_rle_masks(masks):
+    return bool(masks) and isinstance(masks[0]["segmentation"], dict)
+
+def rasterize_rle_masks(rles, image=None):
+    """
+    Decodes COCO RLE masks one at a time into a shared label image (build_label_map convention),
+    also returning the (N, 3) average color of each mask. Only one dense mask exists at a time.
+    """
+    h, w = rles[0]["size"]
+    label_map = np.zeros((h, w), dtype=np.min_scalar_type(len(rles)))
+    avg_colors = np.zeros((len(rles), 3))
+    for idx, rle in enumerate(rles):
+        mask = np.ascontiguousarray(mask_utils.decode(rle))
+        label_map[mask.view(bool)] = idx + 1
+        if image is not None:
+            avg_colors[idx] = cv2.mean(image, mask=mask)[:3]
+    return label_map, avg_colors
+
+def region_stats_rle(rles, avg_colors):
+    """
+    region_stats_batch from COCO RLE masks; bounding boxes and areas come from pycocotools without decoding.
+    """
+    bboxes = mask_utils.toBbox(rles).astype(np.int64)
+    min_x, min_y, box_width, box_height = bboxes.T
+    mask_area = mask_utils.area(rles).astype(np.int64)
+    avg_b, avg_g, avg_r = avg_colors.T
+    return min_y, min_y + box_height - 1, min_x, min_x + box_width - 1, mask_area, avg_b, avg_g, avg_r
+
+def assign_region_colors(original_img, masks, style, style_library):
+    """
+    Classifies and styles every region. Returns (label_map, lut): the (H, W) label image and the
+    (N+1, 3) uint8 BGR color lookup table whose row 0 is the background.
+    """
+    if not masks:
+        return np.zeros(original_img.shape[:2], dtype=np.uint8), np.zeros((1, 3), dtype=np.uint8)
+    # Row 0 is the background, row i holds the color of mask i-1
+    lut = np.zeros((len(masks) + 1, 3), dtype=np.uint8)
+    use_rle = is_rle_masks(masks)
+    if use_rle:
+        # RLE masks are decoded one at a time straight into the label image
+        rles = [mask_dict["segmentation"] for mask_dict in masks]
+        label_map, avg_colors = rasterize_rle_masks(rles, original_img)
+        region_types = classify_region_stats(original_img.shape[:2], *region_stats_rle(rles, avg_colors))
+    else:
+        region_types = classify_regions_batch(masks, original_img)
+    style_cache = build_style_cache(style, style_library)
+    for idx, region_type in enumerate(region_types):
+        rec, color_bgr = random.choice(style_cache[region_type])
+        print(f"[Region {idx}] {region_type.upper()} | Color: {rec['color']} | Texture: {rec['texture']} | Material: {rec['material']} | Finish: {rec['finish']} | Rating: {rec['rating']} | Keywords: {rec['keywords']}")
+        lut[idx + 1] = color_bgr
+    if not use_rle:
+        label_map = build_label_map(masks)
+    return label_map, lut
+
+def render_styled(original_img, label_map, lut):
+    styled = lut[label_map]
+    np.copyto(styled, original_img, where=(label_map == 0)[..., None])
+    return styled
+
+def render_blended(original_img, label_map, lut, alpha, styled=None):
+    """
+    Dense addWeighted of the original and the styled image (rendered here if not given).
+    """
+    if styled is None:
+        styled = render_styled(original_img, label_map, lut)
+    return cv2.addWeighted(original_img, 1 - alpha, styled, alpha, 0)
+
+def _sdpa_attention_forward(self, x):
+    """
+    SAM image encoder Attention.forward using F.scaled_dot_product_attention on 4-D (B, nHead, HW, C) inputs;
+    the rel-pos bias goes in as a (B, nHead, HW, HW) attn_mask (memory-efficient kernel needs torch >= 2.1).
+    """
+    B, H, W, _ = x.shape
+    qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.unbind(0)
+    attn_bias = None
+    if self.use_rel_pos:
+        Rh = sam_image_encoder.get_rel_pos(H, H, self.rel_pos_h)
+        Rw = sam_image_encoder.get_rel_pos(W, W, self.rel_pos_w)
+        r_q = q.reshape(B * self.num_heads, H, W, -1)
+        rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+        rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+        attn_bias = (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).view(B, self.num_heads, H * W, H * W)
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+    x = x.reshape(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+    return self.proj(x)
+
+class PinnedSamPredictor(SamPredictor):
+    """
+    SamPredictor that copies the resized input image to the GPU from pinned host memory (non-blocking).
+    """
+    @torch.no_grad()
+    def set_image(self, image, image_format="RGB"):
+        assert image_format in ["RGB", "BGR"], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if image_format != self.model.image_format:
+            image = image[..., ::-1]
+        input_image = self.transform.apply_image(image)
+        input_image_torch = torch.from_numpy(np.ascontiguousarray(input_image)).pin_memory()
+        input_image_torch = input_image_torch.to(self.device, non_blocking=True)
+        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        self.set_torch_image(input_image_torch, image.shape[:2])
+
+class Bf16ImageEncoder(torch.nn.Module):
+    """
+    Runs the wrapped image encoder in bfloat16 and returns float32 embeddings; the rest of SAM stays float32.
+    """
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder.to(torch.bfloat16)
+        self.img_size = encoder.img_size
+
+    def forward(self, x):
+        return self.encoder(x.to(torch.bfloat16)).float()
+
+def optimize_sam_encoder(sam_model, device, compile_encoder=False):
+    """
+    SDPA attention + channels-last weights + bfloat16 encoder (+ optional torch.compile) for the image encoder on CUDA.
+    """
+    if device != "cuda":
+        return
+    sam_image_encoder.Attention.forward = _sdpa_attention_forward
+    sam_model.image_encoder = sam_model.image_encoder.to(memory_format=torch.channels_last)
+    assert sam_model.image_encoder.patch_embed.proj.weight.is_contiguous(memory_format=torch.channels_last)
+    if torch.cuda.is_bf16_supported():
+        print("Running SAM image encoder in bfloat16")
+        sam_model.image_encoder = Bf16ImageEncoder(sam_model.image_encoder)
+    if compile_encoder:
+        print("Compiling SAM image encoder with torch.compile")
+        sam_model.image_encoder = torch.compile(sam_model.image_encoder, mode="max-autotune")
+
+def filter_masks(masks, min_area, iou_threshold):
+    """
+    Drops masks with area <= min_area, then greedy NMS by decreasing area (reject IoU > iou_threshold with a kept mask).
+    """
+    candidates = sorted((m for m in masks if m["area"] > min_area), key=lambda m: -m["area"])
+    if not candidates:
+        return []
+    if is_rle_masks(candidates):
+        rles = [mask_dict["segmentation"] for mask_dict in candidates]
+    else:
+        # Encode binary masks once; IoUs are then computed on the RLEs
+        rles = [mask_utils.encode(np.asfortranarray(mask_dict["segmentation"], dtype=np.uint8)) for mask_dict in candidates]
+    ious = mask_utils.iou(rles, rles, [0] * len(rles))
+    keep = []
+    for idx in range(len(candidates)):
+        if keep and np.any(ious[idx, keep] > iou_threshold):
+            continue
+        keep.append(idx)
+    return [candidates[idx] for idx in keep]
+
+def save_image(path, image):
+    """
+    cv2.imwrite of a BGR image with fast (level 1) PNG compression; raises IOError on failure.
+    """
+    if not cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+        raise IOError(f"Could not write image to {path}")
+
+def estimate_points_per_batch(image_shape, max_points):
+    """
+    Largest power-of-two point batch whose float32 logits (3 x (1024^2 + H*W) per point) fit in half the free GPU memory (cached blocks count as free).
+    """
+    free_bytes, _ = torch.cuda.mem_get_info()
+    free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    bytes_per_point = 3 * 4 * (1024 * 1024 + image_shape[0] * image_shape[1])
+    points = max(1, min(free_bytes // 2 // bytes_per_point, max_points))
+    return 1 << (points.bit_length() - 1)
+
+def generate_masks(mask_generator, image, auto_batch=False):
+    """
+    mask_generator.generate, optionally sizing points_per_batch from free GPU memory; halves it and retries on CUDA out-of-memory.
+    """
+    if auto_batch:
+        mask_generator.points_per_batch = estimate_points_per_batch(image.shape[:2], len(mask_generator.point_grids[0]))
+        print(f"Decoding {mask_generator.points_per_batch} prompt points per batch")
+    while True:
+        try:
+            return mask_generator.generate(image)
+        except torch.cuda.OutOfMemoryError:
+            if mask_generator.points_per_batch <= 1:
+                raise
+            torch.cuda.empty_cache()
+            mask_generator.points_per_batch //= 2
+            print(f"Out of GPU memory, retrying with points_per_batch={mask_generator.points_per_batch}")
+
+def load_models(args):
+    """
+    Loads the style library and SAM once; returns {'mask_generator', 'auto_batch'}.
+    """
     # Load style library
     print(f"Loading style library from {args.style_library}")
+    global STYLE_LIBRARY
     with open(args.style_library, "r") as file:
         STYLE_LIBRARY = json.load(file)
     
@@ -125,62 +328,135 @@ def main():
     print(f"Using device: {device}")
     sam_model = sam_model_registry[model_type](checkpoint=args.model)
     sam_model.to(device)
-    mask_generator = SamAutomaticMaskGenerator(sam_model)
+    optimize_sam_encoder(sam_model, device, compile_encoder=args.compile)
+    mask_generator = SamAutomaticMaskGenerator(
+        sam_model,
+        points_per_side=args.points_per_side,
+        points_per_batch=args.points_per_batch or CPU_POINTS_PER_BATCH,
+        output_mode=args.output_mode,
+    )
+    if device == "cuda":
+        mask_generator.predictor = PinnedSamPredictor(sam_model)
+    auto_batch = device == "cuda" and args.points_per_batch is None
+    return {"mask_generator": mask_generator, "auto_batch": auto_batch}
+
+def process_image(args, models):
+    missing = [name for name in ("input", "output_blended", "style") if not getattr(args, name, None)]
+    if missing:
+        raise ValueError(f"Missing required options: {', '.join(missing)}")
     
     # Process input image
     print(f"Processing input image: {args.input}")
-    img = Image.open(args.input)
-    img_np = np.array(img)
-    
-    # Convert image to BGR for OpenCV processing
-    if img_np.shape[2] == 4:  # RGBA
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGR)
-    elif img_np.shape[2] == 3:  # RGB
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-    else:
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
+    # 3-channel BGR (alpha dropped, grayscale expanded)
+    img_bgr = cv2.imread(args.input, cv2.IMREAD_COLOR)
+    if img_bgr is None:
+        raise IOError(f"Could not read input image: {args.input}")
     
     # Generate masks using SAM
     print("Generating image segments with SAM...")
-    masks = mask_generator.generate(img_bgr)
+    with torch.inference_mode():
+        masks = generate_masks(models["mask_generator"], cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB), models["auto_batch"])
     print(f"Generated {len(masks)} masks")
     
+    # Skip tiny and redundant masks before classification
+    min_mask_area = args.min_mask_area if args.min_mask_area is not None else 0.002 * img_bgr.shape[0] * img_bgr.shape[1]
+    masks = filter_masks(masks, min_mask_area, args.mask_nms_iou)
+    print(f"Kept {len(masks)} masks after area and overlap filtering")
+    
     # Apply selected style
     print(f"Applying {args.style} style...")
-    styled_image = apply_style_recommendations(img_bgr, masks, args.style, STYLE_LIBRARY)
-    styled_image_rgb = cv2.cvtColor(styled_image, cv2.COLOR_BGR2RGB)
+    label_map, lut = assign_region_colors(img_bgr, masks, args.style, STYLE_LIBRARY)
     
-    # Save styled image
-    print(f"Saving styled image to {args.output_styled}")
-    Image.fromarray(styled_image_rgb).save(args.output_styled)
+    # PNG encoding runs on a worker thread so it overlaps with blending
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        save_futures = []
+        styled_image = None
+        if args.output_styled:
+            print(f"Saving styled image to {args.output_styled}")
+            styled_image = render_styled(img_bgr, label_map, lut)
+            save_futures.append(executor.submit(save_image, args.output_styled, styled_image))
+        
+        # Blend images
+        print(f"Creating blended image with alpha={args.blend_alpha}...")
+        blended = render_blended(img_bgr, label_map, lut, args.blend_alpha, styled_image)
+        
+        # Save blended image
+        print(f"Saving blended image to {args.output_blended}")
+        save_futures.append(executor.submit(save_image, args.output_blended, blended))
+        for future in save_futures:
+            future.result()
     
-    # Create blended image
-    if img_np.shape[:2] != styled_image_rgb.shape[:2]:
-        print("Resizing styled image to match original image dimensions.")
-        styled_image_rgb = cv2.resize(styled_image_rgb, (img_np.shape[1], img_np.shape[0]))
-    
-    # Convert both images to BGR for blending
-    if img_np.shape[2] == 4:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGR)
-    elif img_np.shape[2] == 3:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-    else:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
-    
-    styled_image_bgr = cv2.cvtColor(styled_image_rgb, cv2.COLOR_RGB2BGR)
+    print("Processing completed successfully.")
+
+def serve(args, models):
+    """
+    Keeps models resident; one JSON request per line over an owner-only Unix socket,
+    keys limited to SERVE_REQUEST_KEYS with CLI values as defaults, answered with {"status": "ok"} or {"status": "error", "message": ...}.
+    """
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request must be a JSON object")
+                    unknown = request.keys() - SERVE_REQUEST_KEYS
+                    if unknown:
+                        raise ValueError(f"Unsupported request keys: {', '.join(sorted(unknown))}")
+                    process_image(argparse.Namespace(**{**vars(args), **request}), models)
+                    response = {"status": "ok"}
+                except Exception as e:
+                    print(f"Request failed: {e}")
+                    response = {"status": "error", "message": str(e)}
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
     
-    # Blend images
-    print(f"Creating blended image with alpha={args.blend_alpha}...")
-    img_np_bgr = img_np_bgr.astype(np.uint8)
-    styled_image_bgr = styled_image_bgr.astype(np.uint8)
-    blended_bgr = cv2.addWeighted(img_np_bgr, 1 - args.blend_alpha, styled_image_bgr, args.blend_alpha, 0)
-    blended_rgb = cv2.cvtColor(blended_bgr, cv2.COLOR_BGR2RGB)
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(args.serve, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    try:
+        with server:
+            print(f"Serving on {args.serve}")
+            server.serve_forever()
+    finally:
+        os.unlink(args.serve)
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AI House Exterior Design')
+    parser.add_argument('--input', help='Path to input image')
+    parser.add_argument('--output_styled', help='Path to save styled output image (skipped if omitted)')
+    parser.add_argument('--output_blended', help='Path to save blended output image')
+    parser.add_argument('--style', help='Design style to apply')
+    parser.add_argument('--model', required=True, help='Path to SAM model checkpoint')
+    parser.add_argument('--style_library', required=True, help='Path to style library JSON')
+    parser.add_argument('--blend_alpha', type=float, default=0.5, help='Blending factor (0.0-1.0)')
+    parser.add_argument('--compile', action='store_true', help='Compile the SAM image encoder with torch.compile (GPU only)')
+    parser.add_argument('--points_per_side', type=int, default=32, help='Number of prompt points sampled along each image side')
+    parser.add_argument('--points_per_batch', type=int, default=None,
+                        help='Number of prompt points decoded by SAM at once (default: 64 on CPU, sized from free GPU memory on CUDA)')
+    parser.add_argument('--min_mask_area', type=int, default=None, help='Drop masks with at most this many pixels (default: 0.2%% of the image area)')
+    parser.add_argument('--mask_nms_iou', type=float, default=0.7, help='Drop masks overlapping a larger kept mask above this IoU')
+    parser.add_argument('--output_mode', choices=('coco_rle', 'binary_mask'), default='coco_rle',
+                        help='Mask format requested from SAM: compact RLEs, or dense masks classified in one vectorized batch')
+    parser.add_argument('--serve', metavar='SOCKET_PATH',
+                        help='Keep the model loaded and serve JSON requests on this Unix domain socket')
     
-    # Save blended image
-    print(f"Saving blended image to {args.output_blended}")
-    Image.fromarray(blended_rgb).save(args.output_blended)
+    args = parser.parse_args()
+    if args.serve is None and not (args.input and args.output_blended and args.style):
+        parser.error('--input, --output_blended and --style are required unless --serve is given')
+    # Only a Unix socket restricts who may connect; there is no unauthenticated TCP fallback
+    if args.serve is not None and not hasattr(socketserver, "UnixStreamServer"):
+        parser.error('--serve requires Unix domain sockets, which are not available on this platform')
     
-    print("Processing completed successfully.")
+    models = load_models(args)
+    if args.serve is not None:
+        serve(args, models)
+    else:
+        process_image(args, models)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
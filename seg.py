@@ -11,23 +11,35 @@ Dependencies:
 - PyTorch
 - OpenCV
 - NumPy
-- Pillow (PIL)
-- Matplotlib
+- pycocotools (COCO RLE mask handling)
 """
 
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import random
 import json
 import argparse
-from PIL import Image
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
-import matplotlib.pyplot as plt
+import os
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.modeling import image_encoder as sam_image_encoder
+from pycocotools import mask as mask_utils
 
 # Style library will be loaded from command line argument
 STYLE_LIBRARY = {}
 
+# Region types produced by the classifier
+REGION_TYPES = ("main_walls", "side_walls", "upper_lower_walls", "pillars", "balcony", "roof", "doors", "windows")
+
+# Prompt points decoded at once on the CPU (SAM's own default); on CUDA the batch is sized from free memory
+CPU_POINTS_PER_BATCH = 64
+
+# Per-image options a serve request may set; all other options stay as given on the command line
+SERVE_REQUEST_KEYS = frozenset(("input", "output_styled", "output_blended", "style", "blend_alpha", "min_mask_area", "mask_nms_iou"))
+
 def hex_to_bgr(hex_color):
     """
     Convert a hex color string (#RRGGBB) to BGR tuple (B,G,R) used by OpenCV
@@ -38,16 +50,14 @@ def hex_to_bgr(hex_color):
     Returns:
         tuple: BGR color values as (Blue, Green, Red)
     """
-    hex_color = hex_color.lstrip('#')
-    r = int(hex_color[0:2], 16)
-    g = int(hex_color[2:4], 16)
-    b = int(hex_color[4:6], 16)
+    r, g, b = bytes.fromhex(hex_color.lstrip('#'))
     return (b, g, r)
 
 def classify_region(mask, image=None):
     """
     Enhanced region classifier for architectural elements.
-    Uses heuristics based on position, shape, and color to determine region type.
+    Uses heuristics based on position, shape, and color to determine region type; the rules
+    themselves live in classify_region_stats, which this evaluates for a single mask.
     
     Args:
         mask (numpy.ndarray): Binary mask for the region
@@ -57,80 +67,122 @@ def classify_region(mask, image=None):
         str: Classified region type from: 'main_walls', 'side_walls', 'upper_lower_walls', 
              'pillars', 'balcony', 'roof', 'doors', 'windows'
     """
-    # Get coordinates of all pixels in the mask
-    ys, xs = np.where(mask)
-    if len(ys) == 0 or len(xs) == 0:
-        return "main_walls"  # fallback if mask is empty
-    
-    # Calculate dimensions and position statistics
-    h, w = mask.shape
-    min_y, max_y = ys.min(), ys.max()
-    min_x, max_x = xs.min(), xs.max()
-    box_height = max_y - min_y + 1
-    box_width = max_x - min_x + 1
-    box_area = box_height * box_width
-    mask_area = np.sum(mask)
-    area_ratio = mask_area / (h * w)  # Ratio of mask area to total image area
-    aspect = box_width / (box_height + 1e-5)  # Width/height ratio (add small epsilon to avoid division by zero)
-    center_y = (min_y + max_y) / 2 / h  # Normalized vertical center (0-1)
-    center_x = (min_x + max_x) / 2 / w  # Normalized horizontal center (0-1)
-
-    # Calculate average color if image is provided
-    avg_b, avg_g, avg_r = 0, 0, 0
-    if image is not None:
-        region_pixels = image[mask == 1]
-        if len(region_pixels) > 0:
-            avg_b, avg_g, avg_r = np.mean(region_pixels, axis=0)
+    return classify_region_stats(mask.shape, *region_stats_batch(mask[None], image))[0]
 
-    # --- Classification Heuristics ---
-    # Each condition uses a combination of position, shape, and color to identify architectural elements
-    
-    # Check for roof: typically at the top, wide, and relatively short
-    if center_y < 0.2 and aspect > 2.5 and box_height < 0.15 * h:
-        return "roof"
-    
-    # Check for balcony: typically in upper half, wide, and medium height
-    if 0.2 < center_y < 0.5 and aspect > 2.0 and 0.08 < box_height/h < 0.25:
-        return "balcony"
-    
-    # Check for pillars: typically tall, narrow, and at the sides
-    if aspect < 0.25 and box_height > 0.4 * h and (center_x < 0.2 or center_x > 0.8):
-        return "pillars"
+def region_stats_batch(stack, image=None):
+    """
+    Computes bounding boxes, areas and average colors for a whole stack of masks at once.
     
-    # Check for side walls: large areas at the sides
-    if area_ratio > 0.15 and (center_x < 0.3 or center_x > 0.7):
-        return "side_walls"
+    Args:
+        stack (numpy.ndarray): (N, H, W) uint8 stack of binary masks
+        image (numpy.ndarray, optional): Original image for color analysis
+        
+    Returns:
+        tuple: (min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r), each an array of length N
+    """
+    n, h, w = stack.shape
+    
+    # Bounding boxes from the rows/columns each mask touches
+    rows = stack.any(axis=2)  # (N, H)
+    cols = stack.any(axis=1)  # (N, W)
+    min_y = rows.argmax(axis=1)
+    max_y = h - 1 - rows[:, ::-1].argmax(axis=1)
+    min_x = cols.argmax(axis=1)
+    max_x = w - 1 - cols[:, ::-1].argmax(axis=1)
+    mask_area = stack.reshape(n, -1).sum(axis=1, dtype=np.int64)
+    
+    # Average color of every mask in one contraction over the mask stack
+    avg_b = avg_g = avg_r = np.zeros(n)
+    if image is not None:
+        color_sums = np.einsum("nhw,hwc->nc", stack, image, dtype=np.float64)
+        avg_b, avg_g, avg_r = (color_sums / np.maximum(mask_area, 1)[:, None]).T
     
-    # Check for upper walls: large areas in the upper half
-    if area_ratio > 0.15 and center_y < 0.5:
-        return "upper_lower_walls"
+    return min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r
+
+def classify_region_stats(shape, min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r):
+    """
+    Evaluates the region classification heuristics element-wise over per-mask statistics.
+    This is the single rule table used for every mask format.
     
-    # Check for main walls: large areas in the lower half
-    if area_ratio > 0.15 and center_y >= 0.5:
-        return "main_walls"
+    Args:
+        shape (tuple): (H, W) of the image
+        min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r (numpy.ndarray): Per-mask statistics
+            as returned by region_stats_batch
+        
+    Returns:
+        list: Region type (see classify_region) for each mask
+    """
+    h, w = shape
     
-    # Check for doors: typically at the bottom, fairly square, and darker color
-    if center_y > 0.7 and aspect > 0.6 and box_area > 0.01 * h * w:
-        if avg_r < 120 and avg_g < 120 and avg_b < 120:
-            return "doors"
+    # Calculate dimensions and position statistics for every mask
+    box_height = max_y - min_y + 1
+    box_width = max_x - min_x + 1
+    box_area = box_height * box_width
+    area_ratio = mask_area / (h * w)
+    aspect = box_width / (box_height + 1e-5)
+    center_y = (min_y + max_y) / 2 / h
+    center_x = (min_x + max_x) / 2 / w
     
-    # Check for windows: various positions, typically taller than wide, often blueish
-    if (aspect < 0.5 and box_height > 0.1 * h) or (center_y < 0.6 and box_area < 0.15 * h * w):
-        if avg_b > avg_r and avg_b > avg_g and avg_b > 130:
-            return "windows"
-        else:
-            return "windows"
+    # --- Classification Heuristics ---
+    # Each condition uses a combination of position, shape, and color to identify architectural
+    # elements; np.select picks the first matching rule, anything else falls back to main walls
+    conditions = [
+        # Empty mask
+        mask_area == 0,
+        # Roof: typically at the top, wide, and relatively short
+        (center_y < 0.2) & (aspect > 2.5) & (box_height < 0.15 * h),
+        # Balcony: typically in upper half, wide, and medium height
+        (0.2 < center_y) & (center_y < 0.5) & (aspect > 2.0) & (0.08 < box_height / h) & (box_height / h < 0.25),
+        # Pillars: typically tall, narrow, and at the sides
+        (aspect < 0.25) & (box_height > 0.4 * h) & ((center_x < 0.2) | (center_x > 0.8)),
+        # Side walls: large areas at the sides
+        (area_ratio > 0.15) & ((center_x < 0.3) | (center_x > 0.7)),
+        # Upper walls: large areas in the upper half
+        (area_ratio > 0.15) & (center_y < 0.5),
+        # Main walls: large areas in the lower half
+        (area_ratio > 0.15) & (center_y >= 0.5),
+        # Doors: typically at the bottom, fairly square, and darker color
+        (center_y > 0.7) & (aspect > 0.6) & (box_area > 0.01 * h * w)
+            & (avg_r < 120) & (avg_g < 120) & (avg_b < 120),
+        # Windows: various positions, typically taller than wide or small in the upper part
+        ((aspect < 0.5) & (box_height > 0.1 * h)) | ((center_y < 0.6) & (box_area < 0.15 * h * w)),
+    ]
+    choices = [
+        "main_walls",
+        "roof",
+        "balcony",
+        "pillars",
+        "side_walls",
+        "upper_lower_walls",
+        "main_walls",
+        "doors",
+        "windows",
+    ]
+    return np.select(conditions, choices, default="main_walls").tolist()
+
+def classify_regions_batch(masks, image=None):
+    """
+    Vectorized version of classify_region that classifies all masks at once.
+    Bounding boxes, areas and average colors are computed for the whole mask stack in a
+    single pass, and the same heuristics are evaluated as element-wise arrays.
     
-    # Default case: if area is significant, classify as main walls
-    if area_ratio > 0.10:
-        return "main_walls"
+    Args:
+        masks (list): List of mask dictionaries from SAM
+        image (numpy.ndarray, optional): Original image for color analysis
+        
+    Returns:
+        list: Region type (see classify_region) for each mask, in the same order as masks
+    """
+    if not masks:
+        return []
     
-    # Final fallback
-    return "main_walls"
+    # Stack all masks into a single (N, H, W) uint8 tensor
+    stack = np.stack([mask_dict["segmentation"] for mask_dict in masks]).view(np.uint8)
+    return classify_region_stats(stack.shape[1:], *region_stats_batch(stack, image))
 
-def recommend_style_for_region(region_type, style, style_library):
+def style_options_for_region(region_type, style, style_library):
     """
-    Selects appropriate style recommendations for a region from the style library.
+    Looks up the style recommendations available for a region in the style library.
     Includes fallback mechanisms if the specific style is not available for the region.
     
     Args:
@@ -139,7 +191,7 @@ def recommend_style_for_region(region_type, style, style_library):
         style_library (dict): Library of design styles for different regions
         
     Returns:
-        tuple: (color, texture, material, finish, rating, keywords) for the region
+        list: Style recommendation dictionaries for the region
     """
     # Try to get styles for the specific region type
     region_styles = style_library.get(region_type, {})
@@ -156,66 +208,383 @@ def recommend_style_for_region(region_type, style, style_library):
                 style_list = style_library[region][style]
                 break
     
-    # Select a random style recommendation from the available options
-    rec = random.choice(style_list)
-    return rec["color"], rec["texture"], rec["material"], rec["finish"], rec["rating"], rec["keywords"]
+    return style_list
 
-def apply_style_recommendations(original_img, masks, style, style_library):
+def build_style_cache(style, style_library):
     """
-    Applies style recommendations to each segmented region of the image.
+    Resolves the style recommendations of every region type once per run, so that styling a
+    region is a single dictionary lookup. Colors are converted to BGR up front.
+    
+    Args:
+        style (str): Selected design style
+        style_library (dict): Library of design styles for different regions
+        
+    Returns:
+        dict: Maps each region type to a list of (recommendation, bgr_color) tuples
+    """
+    return {
+        region_type: [
+            (rec, hex_to_bgr(rec["color"])) for rec in style_options_for_region(region_type, style, style_library)
+        ]
+        for region_type in REGION_TYPES
+    }
+
+def build_label_map(masks):
+    """
+    Collapses the SAM masks into a single label image in one vectorized pass.
     
     Args:
-        original_img (numpy.ndarray): Original image in BGR format
         masks (list): List of mask dictionaries from SAM
+        
+    Returns:
+        numpy.ndarray: (H, W) label image where value i (1-based) means mask i-1 covers the
+                       pixel and 0 means no mask does. Later masks take precedence, matching
+                       the order in which regions are painted.
+    """
+    # Stack the boolean masks as a (N, H, W) uint8 tensor without copying the data again
+    seg = np.stack([mask_dict["segmentation"] for mask_dict in masks]).view(np.uint8)
+    
+    # argmax over the reversed stack finds the last mask covering each pixel
+    labels = len(masks) - seg[::-1].argmax(axis=0)
+    labels[seg.max(axis=0) == 0] = 0  # Pixels not covered by any mask keep the background label
+    return labels.astype(np.min_scalar_type(len(masks)))
+
+def is_rle_masks(masks):
+    """
+    Returns True if the SAM masks were generated with output_mode="coco_rle".
+    """
+    return bool(masks) and isinstance(masks[0]["segmentation"], dict)
+
+def rasterize_rle_masks(rles, image=None):
+    """
+    Decodes COCO RLE masks one at a time straight into a shared label image, measuring the
+    average color of each mask while it is decoded. Only one dense mask exists at any time.
+    
+    Args:
+        rles (list): COCO RLE masks as produced by SAM with output_mode="coco_rle"
+        image (numpy.ndarray, optional): Original image for color analysis
+        
+    Returns:
+        tuple: (label_map, avg_colors) where label_map follows the build_label_map convention and
+               avg_colors is an (N, 3) array of average colors in the image's channel order
+    """
+    h, w = rles[0]["size"]
+    label_map = np.zeros((h, w), dtype=np.min_scalar_type(len(rles)))
+    avg_colors = np.zeros((len(rles), 3))
+    for idx, rle in enumerate(rles):
+        mask = np.ascontiguousarray(mask_utils.decode(rle))
+        label_map[mask.view(bool)] = idx + 1  # Later masks take precedence
+        if image is not None:
+            avg_colors[idx] = cv2.mean(image, mask=mask)[:3]
+    return label_map, avg_colors
+
+def region_stats_rle(rles, avg_colors):
+    """
+    Computes the same per-mask statistics as region_stats_batch directly from COCO RLE masks.
+    Bounding boxes and areas come from pycocotools without decoding the masks.
+    
+    Args:
+        rles (list): COCO RLE masks
+        avg_colors (numpy.ndarray): (N, 3) BGR average colors from rasterize_rle_masks
+        
+    Returns:
+        tuple: (min_y, max_y, min_x, max_x, mask_area, avg_b, avg_g, avg_r), each an array of length N
+    """
+    bboxes = mask_utils.toBbox(rles).astype(np.int64)  # (N, 4) as x, y, width, height
+    min_x, min_y, box_width, box_height = bboxes.T
+    mask_area = mask_utils.area(rles).astype(np.int64)
+    avg_b, avg_g, avg_r = avg_colors.T
+    return min_y, min_y + box_height - 1, min_x, min_x + box_width - 1, mask_area, avg_b, avg_g, avg_r
+
+def assign_region_colors(original_img, masks, style, style_library):
+    """
+    Classifies each segmented region, picks a style recommendation for it and builds the
+    label image and color lookup table used to render the styled and blended outputs.
+    
+    Args:
+        original_img (numpy.ndarray): Original image in BGR format
+        masks (list): List of mask dictionaries from SAM, either binary masks or COCO RLEs
         style (str): Selected design style
         style_library (dict): Library of design styles
         
     Returns:
-        numpy.ndarray: Styled image with colors applied to each region
+        tuple: (label_map, lut) where label_map is the (H, W) label image from build_label_map
+               and lut is the (N+1, 3) uint8 BGR color lookup table (row 0 is the background)
     """
-    # Create a copy of the original image to modify
-    output_img = original_img.copy()
+    if not masks:
+        return np.zeros(original_img.shape[:2], dtype=np.uint8), np.zeros((1, 3), dtype=np.uint8)
+    
+    # Color lookup table: row 0 is the background, row i holds the color of mask i-1
+    lut = np.zeros((len(masks) + 1, 3), dtype=np.uint8)
+    
+    # Classify all regions at once based on mask shape, position and color
+    use_rle = is_rle_masks(masks)
+    if use_rle:
+        # RLE masks are decoded one at a time straight into the label image
+        rles = [mask_dict["segmentation"] for mask_dict in masks]
+        label_map, avg_colors = rasterize_rle_masks(rles, original_img)
+        region_types = classify_region_stats(original_img.shape[:2], *region_stats_rle(rles, avg_colors))
+    else:
+        region_types = classify_regions_batch(masks, original_img)
+    
+    # Resolve the style recommendations of every region type once
+    style_cache = build_style_cache(style, style_library)
     
     # Process each mask (segment) in the image
-    for idx, mask_dict in enumerate(masks):
-        # Get the binary mask for this segment
-        mask = mask_dict["segmentation"]
-        
-        # Classify the region type based on the mask shape and position
-        region_type = classify_region(mask, original_img)
-        
+    for idx, region_type in enumerate(region_types):
         # Get style recommendations for this region
-        color_hex, texture, material, finish, rating, keywords = recommend_style_for_region(
-            region_type, style, style_library
-        )
+        rec, color_bgr = random.choice(style_cache[region_type])
         
         # Print details about the region and its recommended style
-        print(f"[Region {idx}] {region_type.upper()} | Color: {color_hex} | Texture: {texture} | Material: {material} | Finish: {finish} | Rating: {rating} | Keywords: {keywords}")
+        print(f"[Region {idx}] {region_type.upper()} | Color: {rec['color']} | Texture: {rec['texture']} | Material: {rec['material']} | Finish: {rec['finish']} | Rating: {rec['rating']} | Keywords: {rec['keywords']}")
         
-        # Convert hex color to BGR format for OpenCV
-        color_bgr = hex_to_bgr(color_hex)
+        # Store the region color in the lookup table
+        lut[idx + 1] = color_bgr
+    
+    # Collapse the masks into a single label image
+    if not use_rle:
+        label_map = build_label_map(masks)
+    return label_map, lut
+
+def render_styled(original_img, label_map, lut):
+    """
+    Paints every region with its color in a single gather pass, keeping the original
+    pixels where no region was found.
+    
+    Args:
+        original_img (numpy.ndarray): Original image in BGR format
+        label_map (numpy.ndarray): (H, W) label image from assign_region_colors
+        lut (numpy.ndarray): (N+1, 3) color lookup table from assign_region_colors
         
-        # Apply the color to all pixels in this mask
-        output_img[mask == 1] = color_bgr
+    Returns:
+        numpy.ndarray: Styled image with colors applied to each region
+    """
+    # The gather writes every pixel once; only background pixels are then restored from the original
+    styled = lut[label_map]
+    np.copyto(styled, original_img, where=(label_map == 0)[..., None])
+    return styled
+
+def render_blended(original_img, label_map, lut, alpha, styled=None):
+    """
+    Blends the styled image into the original image in one dense pass.
+    Background pixels of the styled image equal the original, so they blend back to themselves;
+    a dense blend is still cheaper than gathering and scattering the covered pixels.
     
-    return output_img
+    Args:
+        original_img (numpy.ndarray): Original image in BGR format
+        label_map (numpy.ndarray): (H, W) label image from assign_region_colors
+        lut (numpy.ndarray): (N+1, 3) color lookup table from assign_region_colors
+        alpha (float): Blending factor (0.0-1.0) applied to the region colors
+        styled (numpy.ndarray, optional): Styled image from render_styled; rendered here if omitted
+        
+    Returns:
+        numpy.ndarray: Blended image
+    """
+    if styled is None:
+        styled = render_styled(original_img, label_map, lut)
+    return cv2.addWeighted(original_img, 1 - alpha, styled, alpha, 0)
 
-def main():
+def _sdpa_attention_forward(self, x):
     """
-    Main function that handles command-line arguments and orchestrates the image processing workflow.
+    Replacement for segment_anything's image encoder Attention.forward that routes the
+    attention through torch's fused F.scaled_dot_product_attention kernel.
+    The decomposed relative position bias is passed to the kernel as an additive mask, which
+    the memory-efficient kernel accepts from torch 2.1 on.
     """
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='AI House Exterior Design')
-    parser.add_argument('--input', required=True, help='Path to input image')
-    parser.add_argument('--output_styled', required=True, help='Path to save styled output image')
-    parser.add_argument('--output_blended', required=True, help='Path to save blended output image')
-    parser.add_argument('--style', required=True, help='Design style to apply')
-    parser.add_argument('--model', required=True, help='Path to SAM model checkpoint')
-    parser.add_argument('--style_library', required=True, help='Path to style library JSON')
-    parser.add_argument('--blend_alpha', type=float, default=0.5, help='Blending factor (0.0-1.0)')
+    B, H, W, _ = x.shape
+    # qkv with shape (3, B, nHead, H * W, C)
+    qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+    # q, k, v with shape (B, nHead, H * W, C); the fused kernels only accept 4-D inputs
+    q, k, v = qkv.unbind(0)
+    
+    attn_bias = None
+    if self.use_rel_pos:
+        # Same bias as add_decomposed_rel_pos, built directly instead of being added to a zero-filled
+        # (B * nHead, H * W, H * W) attention matrix
+        Rh = sam_image_encoder.get_rel_pos(H, H, self.rel_pos_h)
+        Rw = sam_image_encoder.get_rel_pos(W, W, self.rel_pos_w)
+        r_q = q.reshape(B * self.num_heads, H, W, -1)
+        rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+        rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+        attn_bias = (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).view(B, self.num_heads, H * W, H * W)
+    
+    # Default SDPA scaling is head_dim ** -0.5, the same as self.scale
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+    x = x.reshape(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+    return self.proj(x)
+
+class PinnedSamPredictor(SamPredictor):
+    """
+    SamPredictor that stages the resized input image in pinned host memory, so the copy to the
+    GPU is a direct asynchronous DMA transfer instead of going through a pageable staging buffer.
+    """
+    @torch.no_grad()
+    def set_image(self, image, image_format="RGB"):
+        assert image_format in ["RGB", "BGR"], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if image_format != self.model.image_format:
+            image = image[..., ::-1]
+        
+        # Transform the image to the form expected by the model
+        input_image = self.transform.apply_image(image)
+        input_image_torch = torch.from_numpy(np.ascontiguousarray(input_image)).pin_memory()
+        input_image_torch = input_image_torch.to(self.device, non_blocking=True)
+        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        
+        self.set_torch_image(input_image_torch, image.shape[:2])
+
+class Bf16ImageEncoder(torch.nn.Module):
+    """
+    Runs the wrapped SAM image encoder in bfloat16 and hands back float32 embeddings, so the
+    prompt encoder, mask decoder and mask postprocessing keep running in float32.
+    """
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder.to(torch.bfloat16)
+        # Read by Sam.preprocess and SamPredictor
+        self.img_size = encoder.img_size
+    
+    def forward(self, x):
+        return self.encoder(x.to(torch.bfloat16)).float()
+
+def optimize_sam_encoder(sam_model, device, compile_encoder=False):
+    """
+    Speeds up the SAM image encoder, which dominates the runtime of mask generation.
+    On GPUs the convolution weights use the channels-last layout and attention is routed through
+    F.scaled_dot_product_attention; where bfloat16 is supported the encoder alone runs in
+    bfloat16 (see Bf16ImageEncoder). Optionally the encoder is also wrapped with
+    torch.compile, which only pays off when the model is reused for several images.
     
-    args = parser.parse_args()
+    Args:
+        sam_model (torch.nn.Module): SAM model already moved to the target device
+        device (str): Device the model runs on
+        compile_encoder (bool): Whether to compile the image encoder with torch.compile
+    """
+    if device != "cuda":
+        return
     
+    # Fused attention kernel instead of the manual softmax(q @ k^T) @ v
+    sam_image_encoder.Attention.forward = _sdpa_attention_forward
+    
+    # Channels-last layout for the convolutional patch embedding and neck
+    sam_model.image_encoder = sam_model.image_encoder.to(memory_format=torch.channels_last)
+    assert sam_model.image_encoder.patch_embed.proj.weight.is_contiguous(memory_format=torch.channels_last)
+    
+    # Halve the element size of the encoder matmuls where tensor cores support bfloat16
+    if torch.cuda.is_bf16_supported():
+        print("Running SAM image encoder in bfloat16")
+        sam_model.image_encoder = Bf16ImageEncoder(sam_model.image_encoder)
+    
+    if compile_encoder:
+        print("Compiling SAM image encoder with torch.compile")
+        sam_model.image_encoder = torch.compile(sam_model.image_encoder, mode="max-autotune")
+
+def filter_masks(masks, min_area, iou_threshold):
+    """
+    Drops tiny and redundant masks before classification.
+    Masks are ordered by decreasing area and accepted greedily; a mask is rejected if its IoU
+    with any already accepted mask exceeds the threshold. Because later masks are painted on
+    top of earlier ones, smaller details end up drawn over the large regions containing them.
+    
+    Args:
+        masks (list): List of mask dictionaries from SAM, either binary masks or COCO RLEs
+        min_area (int): Masks with an area (in pixels) at or below this value are dropped
+        iou_threshold (float): Maximum IoU allowed between two kept masks
+        
+    Returns:
+        list: Filtered list of mask dictionaries, sorted by decreasing area
+    """
+    candidates = sorted((m for m in masks if m["area"] > min_area), key=lambda m: -m["area"])
+    if not candidates:
+        return []
+    
+    if is_rle_masks(candidates):
+        rles = [mask_dict["segmentation"] for mask_dict in candidates]
+    else:
+        # Binary masks are encoded once (pycocotools expects Fortran-ordered uint8), so overlaps
+        # are computed on the run lengths instead of intersecting full-resolution masks
+        rles = [mask_utils.encode(np.asfortranarray(mask_dict["segmentation"], dtype=np.uint8)) for mask_dict in candidates]
+    
+    # Pairwise IoUs computed by pycocotools directly on the RLEs
+    ious = mask_utils.iou(rles, rles, [0] * len(rles))
+    keep = []
+    for idx in range(len(candidates)):
+        if keep and np.any(ious[idx, keep] > iou_threshold):
+            continue
+        keep.append(idx)
+    return [candidates[idx] for idx in keep]
+
+def save_image(path, image):
+    """
+    Writes a BGR image to disk with OpenCV.
+    PNG outputs use a low compression level, trading a slightly larger file for faster encoding.
+    
+    Args:
+        path (str): Output file path; the format is chosen from the extension
+        image (numpy.ndarray): Image in BGR format
+    """
+    if not cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+        raise IOError(f"Could not write image to {path}")
+
+def estimate_points_per_batch(image_shape, max_points):
+    """
+    Picks how many prompt points SAM can decode at once from the currently free GPU memory.
+    Every point yields 3 float32 mask logits that are upsampled to 1024x1024 and then to the
+    original image size; half of the free memory (including cached but unused blocks) is budgeted for them, leaving headroom for
+    the thresholded masks and the stability scores computed alongside.
+    
+    Args:
+        image_shape (tuple): (height, width) of the input image
+        max_points (int): Number of prompt points in the sampling grid
+        
+    Returns:
+        int: Power-of-two batch size between 1 and max_points
+    """
+    # Blocks held in PyTorch's caching allocator (e.g. from the previous image in server mode)
+    # count as used for the driver but are reusable, so they are added back to the budget
+    free_bytes, _ = torch.cuda.mem_get_info()
+    free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    bytes_per_point = 3 * 4 * (1024 * 1024 + image_shape[0] * image_shape[1])
+    points = max(1, min(free_bytes // 2 // bytes_per_point, max_points))
+    return 1 << (points.bit_length() - 1)
+
+def generate_masks(mask_generator, image, auto_batch=False):
+    """
+    Runs SAM automatic mask generation, decoding as many prompt points per batch as fit in memory.
+    If the GPU still runs out of memory the batch size is halved and generation is retried.
+    
+    Args:
+        mask_generator (SamAutomaticMaskGenerator): Configured mask generator
+        image (numpy.ndarray): Image to segment, in RGB format as expected by SAM
+        auto_batch (bool): Size points_per_batch from the free GPU memory before generating
+        
+    Returns:
+        list: List of mask dictionaries from SAM
+    """
+    if auto_batch:
+        mask_generator.points_per_batch = estimate_points_per_batch(image.shape[:2], len(mask_generator.point_grids[0]))
+        print(f"Decoding {mask_generator.points_per_batch} prompt points per batch")
+    
+    while True:
+        try:
+            return mask_generator.generate(image)
+        except torch.cuda.OutOfMemoryError:
+            if mask_generator.points_per_batch <= 1:
+                raise
+            torch.cuda.empty_cache()
+            mask_generator.points_per_batch //= 2
+            print(f"Out of GPU memory, retrying with points_per_batch={mask_generator.points_per_batch}")
+
+def load_models(args):
+    """
+    Loads the style library and the SAM model. Loading the ViT-H checkpoint dominates the
+    latency of a single-image run, so in server mode this happens only once.
+    
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments
+        
+    Returns:
+        dict: 'mask_generator' and 'auto_batch' entries used by process_image
+    """
     # Load style library from specified path
     print(f"Loading style library from {args.style_library}")
     global STYLE_LIBRARY
@@ -229,62 +598,165 @@ def main():
     print(f"Using device: {device}")
     sam_model = sam_model_registry[model_type](checkpoint=args.model)
     sam_model.to(device)
-    mask_generator = SamAutomaticMaskGenerator(sam_model)
+    optimize_sam_encoder(sam_model, device, compile_encoder=args.compile)
+    # COCO RLEs (the default) avoid keeping a dense (H, W) array per mask around; binary masks
+    # are classified as one stack instead
+    mask_generator = SamAutomaticMaskGenerator(
+        sam_model,
+        points_per_side=args.points_per_side,
+        points_per_batch=args.points_per_batch or CPU_POINTS_PER_BATCH,
+        output_mode=args.output_mode,
+    )
+    if device == "cuda":
+        # Upload input images from pinned memory
+        mask_generator.predictor = PinnedSamPredictor(sam_model)
+    
+    # Without an explicit --points_per_batch the GPU batch is sized per image
+    auto_batch = device == "cuda" and args.points_per_batch is None
+    return {"mask_generator": mask_generator, "auto_batch": auto_batch}
+
+def process_image(args, models):
+    """
+    Segments and styles a single image and saves the outputs.
+    
+    Args:
+        args (argparse.Namespace): Per-image options (input, output_styled, output_blended, style,
+                                   blend_alpha, min_mask_area, mask_nms_iou)
+        models (dict): Loaded models from load_models
+    """
+    missing = [name for name in ("input", "output_blended", "style") if not getattr(args, name, None)]
+    if missing:
+        raise ValueError(f"Missing required options: {', '.join(missing)}")
     
     # Load and preprocess input image
     print(f"Processing input image: {args.input}")
-    img = Image.open(args.input)
-    img_np = np.array(img)
-    
-    # Convert image to BGR for OpenCV processing, handling different input formats
-    if img_np.shape[2] == 4:  # RGBA
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGR)
-    elif img_np.shape[2] == 3:  # RGB
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-    else:
-        img_bgr = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
+    # Decode straight into a 3-channel BGR array (alpha is dropped, grayscale is expanded)
+    img_bgr = cv2.imread(args.input, cv2.IMREAD_COLOR)
+    if img_bgr is None:
+        raise IOError(f"Could not read input image: {args.input}")
     
     # Generate masks using SAM (segment the image)
     print("Generating image segments with SAM...")
-    masks = mask_generator.generate(img_bgr)
+    with torch.inference_mode():
+        masks = generate_masks(models["mask_generator"], cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB), models["auto_batch"])
     print(f"Generated {len(masks)} masks")
     
+    # Skip tiny and redundant masks before classification
+    min_mask_area = args.min_mask_area if args.min_mask_area is not None else 0.002 * img_bgr.shape[0] * img_bgr.shape[1]
+    masks = filter_masks(masks, min_mask_area, args.mask_nms_iou)
+    print(f"Kept {len(masks)} masks after area and overlap filtering")
+    
     # Apply selected style to each segment
     print(f"Applying {args.style} style...")
-    styled_image = apply_style_recommendations(img_bgr, masks, args.style, STYLE_LIBRARY)
-    styled_image_rgb = cv2.cvtColor(styled_image, cv2.COLOR_BGR2RGB)
-    
-    # Save fully styled image
-    print(f"Saving styled image to {args.output_styled}")
-    Image.fromarray(styled_image_rgb).save(args.output_styled)
-    
-    # Create blended image (mixture of original and styled)
-    if img_np.shape[:2] != styled_image_rgb.shape[:2]:
-        print("Resizing styled image to match original image dimensions.")
-        styled_image_rgb = cv2.resize(styled_image_rgb, (img_np.shape[1], img_np.shape[0]))
-    
-    # Convert both images to BGR for blending
-    if img_np.shape[2] == 4:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGR)
-    elif img_np.shape[2] == 3:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-    else:
-        img_np_bgr = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
+    label_map, lut = assign_region_colors(img_bgr, masks, args.style, STYLE_LIBRARY)
     
-    styled_image_bgr = cv2.cvtColor(styled_image_rgb, cv2.COLOR_RGB2BGR)
+    # PNG encoding runs on a worker thread so it overlaps with blending
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        save_futures = []
+        
+        # Save fully styled image; it is only rendered up front when requested and then reused for blending
+        styled_image = None
+        if args.output_styled:
+            print(f"Saving styled image to {args.output_styled}")
+            styled_image = render_styled(img_bgr, label_map, lut)
+            save_futures.append(executor.submit(save_image, args.output_styled, styled_image))
+        
+        # Blend the region colors into the original image using specified alpha factor
+        print(f"Creating blended image with alpha={args.blend_alpha}...")
+        blended = render_blended(img_bgr, label_map, lut, args.blend_alpha, styled_image)
+        
+        # Save blended image
+        print(f"Saving blended image to {args.output_blended}")
+        save_futures.append(executor.submit(save_image, args.output_blended, blended))
+        
+        # Propagate any error raised while saving
+        for future in save_futures:
+            future.result()
     
-    # Blend original and styled images using specified alpha factor
-    print(f"Creating blended image with alpha={args.blend_alpha}...")
-    img_np_bgr = img_np_bgr.astype(np.uint8)
-    styled_image_bgr = styled_image_bgr.astype(np.uint8)
-    blended_bgr = cv2.addWeighted(img_np_bgr, 1 - args.blend_alpha, styled_image_bgr, args.blend_alpha, 0)
-    blended_rgb = cv2.cvtColor(blended_bgr, cv2.COLOR_BGR2RGB)
+    print("Processing completed successfully.")
+
+def serve(args, models):
+    """
+    Keeps the models resident and processes images on request.
+    Clients connect to a Unix domain socket created with owner-only permissions and send one
+    JSON object per line.
+    Only the per-image options in SERVE_REQUEST_KEYS are accepted; missing keys fall back to the
+    values given on the command line. Each request is answered with a JSON line:
+    {"status": "ok"} or {"status": "error", "message": ...}.
     
-    # Save blended image
-    print(f"Saving blended image to {args.output_blended}")
-    Image.fromarray(blended_rgb).save(args.output_blended)
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments, used as per-request defaults
+        models (dict): Loaded models from load_models
+    """
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request must be a JSON object")
+                    unknown = request.keys() - SERVE_REQUEST_KEYS
+                    if unknown:
+                        raise ValueError(f"Unsupported request keys: {', '.join(sorted(unknown))}")
+                    process_image(argparse.Namespace(**{**vars(args), **request}), models)
+                    response = {"status": "ok"}
+                except Exception as e:
+                    print(f"Request failed: {e}")
+                    response = {"status": "error", "message": str(e)}
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+    
+    # Requests are handled one at a time, since they share the model and the GPU.
+    # The socket file is created readable and writable by the owner only
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(args.serve, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    try:
+        with server:
+            print(f"Serving on {args.serve}")
+            server.serve_forever()
+    finally:
+        os.unlink(args.serve)
+
+def main():
+    """
+    Main function that handles command-line arguments and orchestrates the image processing workflow.
+    """
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='AI House Exterior Design')
+    parser.add_argument('--input', help='Path to input image')
+    parser.add_argument('--output_styled', help='Path to save styled output image (skipped if omitted)')
+    parser.add_argument('--output_blended', help='Path to save blended output image')
+    parser.add_argument('--style', help='Design style to apply')
+    parser.add_argument('--model', required=True, help='Path to SAM model checkpoint')
+    parser.add_argument('--style_library', required=True, help='Path to style library JSON')
+    parser.add_argument('--blend_alpha', type=float, default=0.5, help='Blending factor (0.0-1.0)')
+    parser.add_argument('--compile', action='store_true', help='Compile the SAM image encoder with torch.compile (GPU only)')
+    parser.add_argument('--points_per_side', type=int, default=32, help='Number of prompt points sampled along each image side')
+    parser.add_argument('--points_per_batch', type=int, default=None,
+                        help='Number of prompt points decoded by SAM at once (default: 64 on CPU, sized from free GPU memory on CUDA)')
+    parser.add_argument('--min_mask_area', type=int, default=None, help='Drop masks with at most this many pixels (default: 0.2%% of the image area)')
+    parser.add_argument('--mask_nms_iou', type=float, default=0.7, help='Drop masks overlapping a larger kept mask above this IoU')
+    parser.add_argument('--output_mode', choices=('coco_rle', 'binary_mask'), default='coco_rle',
+                        help='Mask format requested from SAM: compact RLEs, or dense masks classified in one vectorized batch')
+    parser.add_argument('--serve', metavar='SOCKET_PATH',
+                        help='Keep the model loaded and serve JSON requests on this Unix domain socket')
     
-    print("Processing completed successfully.")
+    args = parser.parse_args()
+    if args.serve is None and not (args.input and args.output_blended and args.style):
+        parser.error('--input, --output_blended and --style are required unless --serve is given')
+    # Only a Unix socket restricts who may connect; there is no unauthenticated TCP fallback
+    if args.serve is not None and not hasattr(socketserver, "UnixStreamServer"):
+        parser.error('--serve requires Unix domain sockets, which are not available on this platform')
+    
+    models = load_models(args)
+    if args.serve is not None:
+        serve(args, models)
+    else:
+        process_image(args, models)
 
 # Entry point of the script
 if __name__ == "__main__":